@@ -16,15 +16,18 @@ Date: Jan 1, 2025
 """
 
 import os
-import json
 import logging
 import asyncio
 import aiohttp
+import orjson
 import pyodbc
 import argparse
 import time
-from typing import List, Dict, Any, Set, Tuple
-from datetime import datetime, date
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+from datetime import datetime, date, timedelta
 
 # Configure logging
 logging.basicConfig(
@@ -42,222 +45,578 @@ if not CONNECTION_STRING:
 # API configuration
 MLB_TRANSACTIONS_API_URL = "https://statsapi.mlb.com/api/v1/transactions"
 API_TIMEOUT = 30
-MAX_CONCURRENT_REQUESTS = 10  # Throttle to 10 concurrent requests
+API_MAX_ATTEMPTS = 5  # Attempts per request before giving up on transient failures
+API_MAX_BACKOFF = 30  # Cap in seconds on the exponential retry backoff
+TRANSIENT_HTTP_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Session-wide timeout: overall cap plus separate connect and read limits
+API_CLIENT_TIMEOUT = aiohttp.ClientTimeout(total=API_TIMEOUT, connect=5, sock_read=20)
+MAX_CONCURRENT_REQUESTS = 4  # Throttle to 4 concurrent (multi-player) requests
+PLAYERS_PER_REQUEST = 100  # Player IDs sent per transactions API call
+DNS_CACHE_TTL = 300  # Seconds to cache statsapi.mlb.com DNS lookups
+KEEPALIVE_TIMEOUT = 60  # Seconds to keep idle connections open between batches
+DB_QUEUE_SIZE = 4  # Record chunks buffered between the API fetchers and the DB writer
+WATERMARK_OVERLAP_DAYS = 7  # Re-request this many days before a watermark to catch late postings
+PROGRESS_LOG_INTERVAL = 30  # Minimum seconds between progress log lines
 
+# Team history rows held column-wise as parallel lists:
+# (MLBPlayer IDs, Dates, MLBTeam IDs, Descriptions)
+TeamHistoryColumns = Tuple[List[int], List[date], List[int], List[str]]
+# Result of one successful API request: (records, player IDs requested, fetched-through date)
+TeamHistoryChunk = Tuple[TeamHistoryColumns, List[int], date]
 
-def fetch_valid_mlb_teams() -> Set[int]:
+# One pyodbc connection per thread (main thread + the DB reader and writer threads)
+_db_local = threading.local()
+_db_connections: List[pyodbc.Connection] = []
+_db_connections_lock = threading.Lock()
+
+
+def get_db() -> pyodbc.Connection:
+    """
+    Get this thread's database connection, opening it on first use.
+    
+    Connections start in autocommit mode so read-only queries never hold an open
+    transaction; writers switch autocommit off for their own transactions.
+    
+    Returns:
+        pyodbc Connection reused for the lifetime of the script
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = pyodbc.connect(CONNECTION_STRING, autocommit=True)
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+
+def close_db_connections() -> None:
+    """
+    Close every connection opened by get_db().
+    """
+    with _db_connections_lock:
+        for conn in _db_connections:
+            try:
+                conn.close()
+            except pyodbc.Error as e:
+                logger.warning(f"Failed to close database connection: {e}")
+        _db_connections.clear()
+
+
+# Restricts MLBPlayer queries (aliased p) to players with at least one loaded transaction
+KNOWN_PLAYERS_FILTER = """
+    AND EXISTS (SELECT 1 FROM MLBPlayer_TeamHistory h WHERE h.MLBPlayer = p.Player)
+"""
+
+
+def count_valid_mlb_players(start_id: int, end_id: int, known_only: bool = False) -> int:
     """
-    Fetch all valid MLBTeam IDs from the database.
+    Count valid MLBPlayer IDs in the database within the specified range.
     
+    Args:
+        start_id: Start of player ID range
+        end_id: End of player ID range
+        known_only: Only count players with at least one loaded transaction
+        
     Returns:
-        Set of valid MLBTeam IDs
+        Number of MLBPlayer IDs that exist in our database
     """
-    logger.info("Fetching valid MLBTeam IDs from database")
+    logger.info(f"Counting valid MLBPlayer IDs in database for range {start_id}-{end_id}")
     
     try:
-        conn = pyodbc.connect(CONNECTION_STRING)
-        cursor = conn.cursor()
+        cursor = get_db().cursor()
         
-        cursor.execute("SELECT MLBTeam FROM MLBTeam")
-        results = cursor.fetchall()
+        cursor.execute(
+            "SELECT COUNT(*) FROM MLBPlayer p WHERE p.Player BETWEEN ? AND ?"
+            + (KNOWN_PLAYERS_FILTER if known_only else ""),
+            (start_id, end_id)
+        )
+        total_players = cursor.fetchone()[0]
+        logger.info(f"Found {total_players} valid MLBPlayer IDs in the specified range")
         
-        valid_teams = {row[0] for row in results}
-        logger.info(f"Found {len(valid_teams)} valid MLBTeam IDs")
+        return total_players
         
-        return valid_teams
+    except Exception as e:
+        logger.error(f"Failed to count valid MLBPlayer IDs: {e}")
+        raise
+    finally:
+        if 'cursor' in locals():
+            cursor.close()
+
+
+def fetch_valid_mlb_player_page(last_id: int, end_id: int, batch_size: int,
+                                known_only: bool = False) -> List[int]:
+    """
+    Fetch the next page of valid MLBPlayer IDs after last_id.
+    
+    Uses keyset paging (Player > last seen ID) so each page is an index seek rather
+    than an OFFSET scan.
+    
+    Args:
+        last_id: Last player ID of the previous page
+        end_id: End of player ID range
+        batch_size: Maximum number of IDs per page
+        known_only: Only return players with at least one loaded transaction
+        
+    Returns:
+        Ascending list of MLBPlayer IDs that exist in our database
+    """
+    try:
+        cursor = get_db().cursor()
+        
+        cursor.execute(
+            "SELECT TOP (?) p.Player FROM MLBPlayer p WHERE p.Player > ? AND p.Player <= ?"
+            + (KNOWN_PLAYERS_FILTER if known_only else "")
+            + " ORDER BY p.Player",
+            (batch_size, last_id, end_id)
+        )
+        return [row[0] for row in cursor.fetchall()]
         
     except Exception as e:
-        logger.error(f"Failed to fetch valid MLBTeam IDs: {e}")
+        logger.error(f"Failed to fetch valid MLBPlayer IDs after {last_id}: {e}")
         raise
     finally:
         if 'cursor' in locals():
             cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-def fetch_valid_mlb_players(start_id: int, end_id: int) -> Set[int]:
+async def iter_valid_mlb_players(executor: ThreadPoolExecutor, start_id: int, end_id: int,
+                                 batch_size: int, known_only: bool = False) -> AsyncIterator[List[int]]:
     """
-    Fetch all valid MLBPlayer IDs from the database within the specified range.
+    Page through valid MLBPlayer IDs in the database within the specified range.
+    
+    Pages are queried on the reader executor's own connection, and the next page is
+    prefetched while the current one is processed, so paging never blocks the event
+    loop. Memory stays proportional to batch_size.
     
     Args:
+        executor: Single-thread executor that owns the reader's DB connection
         start_id: Start of player ID range
         end_id: End of player ID range
+        batch_size: Maximum number of IDs per page
+        known_only: Only yield players with at least one loaded transaction
+        
+    Yields:
+        Ascending lists of MLBPlayer IDs that exist in our database
+    """
+    loop = asyncio.get_running_loop()
+    next_page = loop.run_in_executor(executor, fetch_valid_mlb_player_page,
+                                     start_id - 1, end_id, batch_size, known_only)
+    
+    while next_page is not None:
+        page = await next_page
+        if not page:
+            return
+        
+        # Start the following query before handing this page to the caller
+        next_page = None
+        if len(page) == batch_size:
+            next_page = loop.run_in_executor(executor, fetch_valid_mlb_player_page,
+                                             page[-1], end_id, batch_size, known_only)
+        
+        yield page
+
+
+# Transaction dates repeat heavily across players, so parsed dates are cached by string
+_date_cache: Dict[str, date] = {}
+
+
+def parse_iso_date(date_str: str) -> date:
+    """
+    Parse a "YYYY-MM-DD" date string, caching results.
+    
+    Slices the fixed-width fields directly instead of calling strptime per row,
+    falling back to strptime for anything that is not exactly 10 characters.
+    
+    Args:
+        date_str: Date string from the transactions API
         
     Returns:
-        Set of valid MLBPlayer IDs that exist in our database
+        Parsed date
+        
+    Raises:
+        ValueError: If the string is not a valid date
     """
-    logger.info(f"Fetching valid MLBPlayer IDs from database for range {start_id}-{end_id}")
+    parsed = _date_cache.get(date_str)
+    if parsed is None:
+        if len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-':
+            parsed = date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+        else:
+            parsed = datetime.strptime(date_str, '%Y-%m-%d').date()
+        _date_cache[date_str] = parsed
+    return parsed
+
+
+def ensure_watermark_table() -> None:
+    """
+    Create the MLBPlayer_TeamHistory_Watermark table if it does not exist yet.
     
+    A newly created table is seeded from the history already in MLBPlayer_TeamHistory,
+    so the first incremental run does not refetch every player's full history.
+    """
     try:
-        conn = pyodbc.connect(CONNECTION_STRING)
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute("SELECT Player FROM MLBPlayer WHERE Player BETWEEN ? AND ?", (start_id, end_id))
+        cursor.execute("SELECT OBJECT_ID('dbo.MLBPlayer_TeamHistory_Watermark', 'U')")
+        if cursor.fetchone()[0] is not None:
+            return
+        
+        logger.info("Creating and seeding MLBPlayer_TeamHistory_Watermark")
+        conn.autocommit = False  # Create and seed atomically
+        cursor.execute("""
+        CREATE TABLE dbo.MLBPlayer_TeamHistory_Watermark (
+            MLBPlayer INT NOT NULL PRIMARY KEY,
+            LastDate DATE NOT NULL
+        )
+        """)
+        cursor.execute("""
+        INSERT INTO dbo.MLBPlayer_TeamHistory_Watermark (MLBPlayer, LastDate)
+        SELECT MLBPlayer, MAX(Date)
+        FROM MLBPlayer_TeamHistory
+        GROUP BY MLBPlayer
+        """)
+        seeded = cursor.rowcount
+        conn.commit()
+        logger.info(f"Seeded {seeded} player watermarks from existing team history")
+        
+    except Exception as e:
+        logger.error(f"Failed to create player watermark table: {e}")
+        if 'conn' in locals():
+            conn.rollback()
+        raise
+    finally:
+        if 'cursor' in locals():
+            cursor.close()
+        if 'conn' in locals():
+            conn.autocommit = True
+
+
+def fetch_player_watermarks(start_id: int, end_id: int) -> Dict[int, date]:
+    """
+    Fetch the date each player's transactions have been fetched through within the specified range.
+    
+    Args:
+        start_id: Start of player ID range
+        end_id: End of player ID range
+        
+    Returns:
+        Dict mapping MLBPlayer ID to its watermark date
+    """
+    logger.info(f"Fetching player watermarks from database for range {start_id}-{end_id}")
+    
+    try:
+        cursor = get_db().cursor()
+        
+        cursor.execute(
+            "SELECT MLBPlayer, LastDate FROM MLBPlayer_TeamHistory_Watermark WHERE MLBPlayer BETWEEN ? AND ?",
+            (start_id, end_id)
+        )
         results = cursor.fetchall()
         
-        valid_players = {row[0] for row in results}
-        logger.info(f"Found {len(valid_players)} valid MLBPlayer IDs in the specified range")
+        watermarks = {row[0]: row[1] for row in results}
+        logger.info(f"Found {len(watermarks)} player watermarks in the specified range")
         
-        return valid_players
+        return watermarks
         
     except Exception as e:
-        logger.error(f"Failed to fetch valid MLBPlayer IDs: {e}")
+        logger.error(f"Failed to fetch player watermarks: {e}")
         raise
     finally:
         if 'cursor' in locals():
             cursor.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-async def fetch_player_transactions(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, 
-                                  player_id: int, valid_teams: Set[int]) -> List[Tuple[int, date, int, str]]:
+async def get_json_with_retry(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                              url: str, batch_label: str) -> Dict[str, Any]:
     """
-    Fetch transactions for a single player from MLB Stats API using async HTTP.
+    GET a URL and parse the JSON body, retrying transient failures.
+    
+    Connection errors, timeouts and transient HTTP statuses (429/5xx) are retried with
+    jittered exponential backoff, honoring Retry-After (capped at API_MAX_BACKOFF) when
+    the API sends one. Other HTTP errors (e.g. 404) are permanent and raised immediately.
+    
+    Args:
+        session: aiohttp ClientSession
+        semaphore: asyncio Semaphore for throttling (released while backing off)
+        url: Request URL
+        batch_label: Player ID range used in log messages
+        
+    Returns:
+        Parsed JSON response
+        
+    Raises:
+        aiohttp.ClientError: On permanent HTTP errors or once retries are exhausted
+        asyncio.TimeoutError: If the final attempt times out
+    """
+    for attempt in range(1, API_MAX_ATTEMPTS + 1):
+        retry_after = None
+        
+        try:
+            async with semaphore:  # Throttle concurrent requests
+                async with session.get(url) as response:
+                    if response.status in TRANSIENT_HTTP_STATUSES and attempt < API_MAX_ATTEMPTS:
+                        try:
+                            # Clamp so a huge or negative header cannot stall or skip the backoff
+                            retry_after = max(0.0, min(API_MAX_BACKOFF,
+                                                       float(response.headers.get('Retry-After', ''))))
+                        except ValueError:
+                            retry_after = None
+                        logger.warning("HTTP %s for players %s (attempt %s/%s)",
+                                       response.status, batch_label, attempt, API_MAX_ATTEMPTS)
+                    else:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+                        
+        except aiohttp.ClientResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == API_MAX_ATTEMPTS:
+                raise
+            logger.warning("Request failed for players %s (attempt %s/%s): %r",
+                           batch_label, attempt, API_MAX_ATTEMPTS, e)
+        
+        if retry_after is None:
+            retry_after = min(API_MAX_BACKOFF, 0.5 * 2 ** (attempt - 1)) + random.random()
+        await asyncio.sleep(retry_after)
+    
+    raise RuntimeError("unreachable")  # The final attempt always returns or raises
+
+
+async def fetch_batch_transactions(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                   player_ids: List[int],
+                                   start_date: Optional[date] = None) -> Optional[TeamHistoryChunk]:
+    """
+    Fetch transactions for a group of players from MLB Stats API with a single async HTTP request.
+    
+    The transactions endpoint accepts a comma-separated playerId list, so the response
+    is demultiplexed by person.id instead of issuing one request per player.
     
     Args:
         session: aiohttp ClientSession
         semaphore: asyncio Semaphore for throttling
-        player_id: MLB player ID
-        valid_teams: Set of valid MLBTeam IDs for filtering
+        player_ids: MLB player IDs to fetch in one request (already validated against MLBPlayer)
+        start_date: Only request transactions on or after this date (None for full history)
         
     Returns:
-        List of tuples (MLBPlayer, Date, MLBTeam, Description)
+        Tuple of (TeamHistoryColumns, player_ids, fetched-through date), or None if the
+        request failed
     """
-    url = f"{MLB_TRANSACTIONS_API_URL}?playerId={player_id}"
+    # A full fetch can load future-dated transactions, so never end before the start
+    end_date = max(date.today(), start_date) if start_date else date.today()
+    url = f"{MLB_TRANSACTIONS_API_URL}?playerId={','.join(map(str, player_ids))}"
+    if start_date:
+        url += f"&startDate={start_date.isoformat()}&endDate={end_date.isoformat()}"
+    batch_label = f"{min(player_ids)}-{max(player_ids)}"
+    requested_players = frozenset(player_ids)
     
-    async with semaphore:  # Throttle concurrent requests
-        try:
-            logger.debug(f"Fetching transactions for player {player_id}")
-            
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)) as response:
-                response.raise_for_status()
-                data = await response.json()
+    try:
+        logger.debug("Fetching transactions for %s players (%s)", len(player_ids), batch_label)
+        
+        data = await get_json_with_retry(session, semaphore, url, batch_label)
+        transactions = data.get('transactions', [])
+        players: List[int] = []
+        dates: List[date] = []
+        teams: List[int] = []
+        descriptions: List[str] = []
+        
+        for transaction in transactions:
+            # Group by the player the transaction belongs to
+            person = transaction.get('person')
+            if not person:
+                continue
                 
-            transactions = data.get('transactions', [])
-            team_history_records = []
-            
-            for transaction in transactions:
-                # Skip transactions without toTeam
-                to_team = transaction.get('toTeam')
-                if not to_team:
-                    continue
-                    
-                team_id = to_team.get('id')
-                if not team_id or team_id not in valid_teams:
-                    continue
-                    
-                # Parse the transaction date
-                transaction_date_str = transaction.get('date')
-                if not transaction_date_str:
-                    continue
-                    
-                try:
-                    # Parse date string (format: "2023-06-17")
-                    transaction_date = datetime.strptime(transaction_date_str, '%Y-%m-%d').date()
-                except ValueError:
-                    logger.warning(f"Invalid date format for player {player_id}: {transaction_date_str}")
-                    continue
+            player_id = person.get('id')
+            if not player_id or player_id not in requested_players:
+                continue
+                
+            # Skip transactions without toTeam
+            to_team = transaction.get('toTeam')
+            if not to_team:
+                continue
                 
-                description = transaction.get('description', '').strip()
-                if len(description) > 255:
-                    description = description[:255]
+            team_id = to_team.get('id')
+            if not team_id:
+                continue
                 
-                team_history_records.append((
-                    player_id,           # MLBPlayer
-                    transaction_date,    # Date
-                    team_id,            # MLBTeam
-                    description         # Description
-                ))
+            # Parse the transaction date
+            transaction_date_str = transaction.get('date')
+            if not transaction_date_str:
+                continue
+                
+            try:
+                # Parse date string (format: "2023-06-17")
+                transaction_date = parse_iso_date(transaction_date_str)
+            except ValueError:
+                logger.warning("Invalid date format for player %s: %s", player_id, transaction_date_str)
+                continue
             
-            logger.debug(f"Player {player_id}: {len(team_history_records)} valid transactions")
-            return team_history_records
+            # Truncate to the column width before stripping so at most 255 chars are copied
+            description = (transaction.get('description') or '')[:255].strip()
             
-        except aiohttp.ClientError as e:
-            logger.warning(f"HTTP request failed for player {player_id}: {e}")
-            return []
-        except asyncio.TimeoutError as e:
-            logger.warning(f"Request timeout for player {player_id}: {e}")
-            return []
-        except json.JSONDecodeError as e:
-            logger.warning(f"JSON decode failed for player {player_id}: {e}")
-            return []
-        except Exception as e:
-            logger.error(f"Unexpected error for player {player_id}: {e}")
-            return []
-
-
-async def process_players_batch(player_ids: List[int], valid_teams: Set[int], valid_players: Set[int]) -> List[Tuple[int, date, int, str]]:
+            players.append(player_id)            # MLBPlayer
+            dates.append(transaction_date)       # Date
+            teams.append(team_id)                # MLBTeam
+            descriptions.append(description)     # Description
+        
+        logger.debug("Players %s: %s valid transactions", batch_label, len(players))
+        return (players, dates, teams, descriptions), player_ids, end_date
+        
+    except aiohttp.ClientError as e:
+        logger.warning("HTTP request failed for players %s: %s", batch_label, e)
+        return None
+    except asyncio.TimeoutError as e:
+        logger.warning("Request timeout for players %s: %s", batch_label, e)
+        return None
+    except ValueError as e:  # Covers orjson and stdlib JSON decode errors
+        logger.warning("JSON decode failed for players %s: %s", batch_label, e)
+        return None
+    except Exception as e:
+        logger.error("Unexpected error for players %s: %s", batch_label, e)
+        return None
+
+
+def group_start_date(player_ids: List[int], watermarks: Dict[int, date]) -> Optional[date]:
+    """
+    Get the start date for a group of players fetched in one request.
+    
+    Args:
+        player_ids: Player IDs sent in the same API request
+        watermarks: Date each player's transactions have been fetched through
+        
+    Returns:
+        Earliest watermark in the group less WATERMARK_OVERLAP_DAYS, or None if any
+        player has never been fetched
+    """
+    group_watermarks = [watermarks.get(pid) for pid in player_ids]
+    if not group_watermarks or None in group_watermarks:
+        return None
+    return min(group_watermarks) - timedelta(days=WATERMARK_OVERLAP_DAYS)
+
+
+async def process_players_batch(session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                player_ids: List[int], watermarks: Dict[int, date],
+                                db_queue: asyncio.Queue, writer: asyncio.Task) -> int:
     """
     Process a batch of players concurrently using async HTTP.
     
+    Each API response is queued for the DB writer as soon as it arrives, so one
+    slow request does not hold back the rest of the batch.
+    
     Args:
-        player_ids: List of player IDs to process (should all be valid)
-        valid_teams: Set of valid MLBTeam IDs for filtering
-        valid_players: Set of valid MLBPlayer IDs for validation
+        session: Shared aiohttp ClientSession
+        semaphore: asyncio Semaphore shared by all in-flight batches for throttling
+        player_ids: List of player IDs to process (paged from MLBPlayer, so all valid)
+        watermarks: Date each player's transactions have been fetched through
+        db_queue: Queue consumed by db_writer
+        writer: The running db_writer task
         
     Returns:
-        List of all team history records from the batch
-    """
-    # Double-check that all player IDs are valid before making any API calls
-    invalid_players = [pid for pid in player_ids if pid not in valid_players]
-    if invalid_players:
-        logger.error(f"Attempting to process invalid player IDs: {invalid_players}")
-        raise ValueError(f"Invalid player IDs detected: {invalid_players}")
-    
-    logger.info(f"Making async API calls for {len(player_ids)} valid players: {player_ids}")
-    
-    # Create semaphore for throttling concurrent requests
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-    
-    # Create aiohttp session
-    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS * 2)  # Allow more connections in pool
-    async with aiohttp.ClientSession(connector=connector) as session:
-        # Create tasks for all players
-        tasks = [
-            fetch_player_transactions(session, semaphore, player_id, valid_teams)
-            for player_id in player_ids
-        ]
-        
-        # Execute all tasks concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Collect successful results
-        all_records = []
-        for i, result in enumerate(results):
-            if isinstance(result, Exception):
-                logger.error(f"Error processing player {player_ids[i]}: {result}")
-            else:
-                all_records.extend(result)
+        Number of team history records queued from the batch
+    """
+    # Per-batch detail is DEBUG only; main() logs throttled progress at INFO
+    logger.debug("Making async API calls for %s valid players (%s to %s)",
+                 len(player_ids), player_ids[0], player_ids[-1])
+    
+    # Group players with similar watermarks (never-fetched players first) so one new
+    # player does not pull a whole request of watermarked players back to full history
+    ordered_ids = sorted(player_ids, key=lambda pid: (pid in watermarks, watermarks.get(pid, date.min)))
+    
+    # Create one task per group of players sharing a single API request
+    player_groups = [
+        ordered_ids[i:i + PLAYERS_PER_REQUEST]
+        for i in range(0, len(ordered_ids), PLAYERS_PER_REQUEST)
+    ]
+    tasks = [
+        asyncio.ensure_future(fetch_batch_transactions(session, semaphore, group,
+                                                       group_start_date(group, watermarks)))
+        for group in player_groups
+    ]
+    
+    # Hand each result to the DB writer in completion order
+    total_records = 0
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            try:
+                chunk = await next_result
+            except Exception as e:
+                logger.error("Error processing player group: %s", e)
+                continue
+            
+            # Queue every successful request, even with no rows, so watermarks advance
+            if chunk is not None:
+                await enqueue_records(db_queue, writer, chunk)
+                total_records += len(chunk[0][0])
+    finally:
+        for task in tasks:
+            task.cancel()
     
-    logger.info(f"Batch completed: {len(all_records)} total team history records collected")
-    return all_records
+    logger.debug("Batch completed: %s total team history records queued", total_records)
+    return total_records
 
 
-def bulk_insert_team_history(records: List[Tuple[int, date, int, str]]) -> None:
+def bulk_insert_team_history(records: TeamHistoryColumns, fetched_players: List[int],
+                             fetched_through: date) -> None:
     """
-    Bulk insert team history records into the database.
+    Bulk insert team history records into the database and advance watermarks.
+    
+    Records are loaded into a temp staging table with fast_executemany and then
+    applied with a single set-based MERGE, rather than one MERGE per row. Every
+    fetched player's watermark moves to fetched_through in the same transaction,
+    including players whose request returned no loadable rows.
     
     Args:
-        records: List of tuples (MLBPlayer, Date, MLBTeam, Description)
+        records: TeamHistoryColumns of (MLBPlayer, Date, MLBTeam, Description) lists
+        fetched_players: Player IDs covered by the successful API request
+        fetched_through: endDate the request covered
     """
-    if not records:
+    record_count = len(records[0])
+    if not record_count and not fetched_players:
         logger.info("No records to insert")
         return
     
-    logger.info(f"Inserting {len(records)} team history records")
+    logger.debug("Inserting %s team history records", record_count)
     
     try:
-        conn = pyodbc.connect(CONNECTION_STRING)
+        conn = get_db()
+        conn.autocommit = False
         cursor = conn.cursor()
         cursor.fast_executemany = True
-        conn.autocommit = False
         
-        # Use MERGE statement to handle potential duplicates (based on primary key)
+        # Stage all rows in a session-scoped temp table (Seq preserves arrival order)
+        cursor.execute("""
+        CREATE TABLE #TempTeamHistory (
+            Seq INT IDENTITY(1, 1) PRIMARY KEY,
+            MLBPlayer INT NOT NULL,
+            Date DATE NOT NULL,
+            MLBTeam SMALLINT NOT NULL,
+            Description NVARCHAR(255) NULL
+        )
+        """)
+        if record_count:
+            cursor.executemany(
+                "INSERT INTO #TempTeamHistory (MLBPlayer, Date, MLBTeam, Description) VALUES (?, ?, ?, ?)",
+                list(zip(*records))  # Rows are only materialized for the duration of the insert
+            )
+        
+        # Drop rows for teams missing from MLBTeam; they are never loaded
+        cursor.execute("""
+        DELETE s FROM #TempTeamHistory s
+        WHERE NOT EXISTS (SELECT 1 FROM MLBTeam t WHERE t.MLBTeam = s.MLBTeam)
+        """)
+        
+        # Single MERGE to handle potential duplicates (based on primary key); the last
+        # staged row per player/date wins, matching the old row-by-row behaviour
         merge_sql = """
         MERGE MLBPlayer_TeamHistory AS target
-        USING (VALUES (?, ?, ?, ?)) AS source (MLBPlayer, Date, MLBTeam, Description)
+        USING (
+            SELECT MLBPlayer, Date, MLBTeam, Description
+            FROM (
+                SELECT MLBPlayer, Date, MLBTeam, Description,
+                       ROW_NUMBER() OVER (PARTITION BY MLBPlayer, Date ORDER BY Seq DESC) AS rn
+                FROM #TempTeamHistory
+            ) AS staged
+            WHERE rn = 1
+        ) AS source (MLBPlayer, Date, MLBTeam, Description)
         ON target.MLBPlayer = source.MLBPlayer AND target.Date = source.Date
         WHEN MATCHED THEN
             UPDATE SET MLBTeam = source.MLBTeam, Description = source.Description
@@ -266,22 +625,156 @@ def bulk_insert_team_history(records: List[Tuple[int, date, int, str]]) -> None:
             VALUES (source.MLBPlayer, source.Date, source.MLBTeam, source.Description);
         """
         
-        cursor.executemany(merge_sql, records)
+        cursor.execute(merge_sql)
+        
+        # Advance every fetched player's watermark in the same transaction as the MERGE
+        cursor.execute("CREATE TABLE #TempFetchedPlayers (MLBPlayer INT NOT NULL PRIMARY KEY)")
+        if fetched_players:
+            cursor.executemany(
+                "INSERT INTO #TempFetchedPlayers (MLBPlayer) VALUES (?)",
+                [(player_id,) for player_id in fetched_players]
+            )
+        cursor.execute("""
+        MERGE MLBPlayer_TeamHistory_Watermark AS target
+        USING (
+            SELECT MLBPlayer, CAST(? AS DATE) AS LastDate
+            FROM #TempFetchedPlayers
+        ) AS source
+        ON target.MLBPlayer = source.MLBPlayer
+        WHEN MATCHED AND source.LastDate > target.LastDate THEN
+            UPDATE SET LastDate = source.LastDate
+        WHEN NOT MATCHED THEN
+            INSERT (MLBPlayer, LastDate)
+            VALUES (source.MLBPlayer, source.LastDate);
+        """, fetched_through)
+        cursor.execute("DROP TABLE #TempTeamHistory")
+        cursor.execute("DROP TABLE #TempFetchedPlayers")
         
         # Commit the transaction
         conn.commit()
-        logger.info(f"Successfully inserted/updated {len(records)} team history records")
+        logger.debug("Successfully inserted/updated %s team history records (%s watermarks through %s)",
+                     record_count, len(fetched_players), fetched_through)
         
     except Exception as e:
-        logger.error(f"Failed to insert team history records: {e}")
+        logger.error("Failed to insert team history records: %s", e)
         if 'conn' in locals():
             conn.rollback()
         raise
     finally:
         if 'cursor' in locals():
             cursor.close()
-        if 'conn' in locals():
-            conn.close()
+
+
+async def db_writer(queue: asyncio.Queue, executor: ThreadPoolExecutor) -> None:
+    """
+    Drain record chunks from the queue and insert them on the DB writer thread.
+    
+    Runs until a None sentinel is received, so inserts overlap with API fetching
+    instead of blocking the event loop.
+    
+    Args:
+        queue: Queue of TeamHistoryChunk items produced by process_players_batch()
+        executor: Single-thread executor that owns the writer's DB connection
+    """
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            break
+        await loop.run_in_executor(executor, bulk_insert_team_history, *chunk)
+
+
+async def enqueue_records(queue: asyncio.Queue, writer: asyncio.Task,
+                          chunk: Optional[TeamHistoryChunk]) -> None:
+    """
+    Put a fetched chunk on the DB queue, surfacing a writer failure instead of blocking forever.
+    
+    Args:
+        queue: Queue consumed by db_writer
+        writer: The running db_writer task
+        chunk: Records and watermark update to apply, or None to signal the writer to finish
+    """
+    put = asyncio.ensure_future(queue.put(chunk))
+    await asyncio.wait({put, writer}, return_when=asyncio.FIRST_COMPLETED)
+    
+    if not put.done():
+        put.cancel()
+        writer.result()  # Re-raises the insert failure
+        raise RuntimeError("DB writer stopped before all records were queued")
+
+
+def max_in_flight_batches(batch_size: int) -> int:
+    """
+    Size the sliding window of concurrently fetched batches.
+    
+    Each batch issues ceil(batch_size / PLAYERS_PER_REQUEST) API requests, so the window
+    must hold enough batches to fill MAX_CONCURRENT_REQUESTS, plus one more so the
+    semaphore still has queued work while a batch is finishing.
+    
+    Args:
+        batch_size: Players per batch
+        
+    Returns:
+        Number of batches to keep in flight
+    """
+    requests_per_batch = -(-batch_size // PLAYERS_PER_REQUEST)  # Ceiling division
+    return -(-MAX_CONCURRENT_REQUESTS // requests_per_batch) + 1
+
+
+async def wait_for_batches(batch_tasks: Dict[asyncio.Task, int],
+                           return_when: str = asyncio.FIRST_COMPLETED) -> Tuple[int, int]:
+    """
+    Wait for in-flight batch tasks to finish and remove them from the window.
+    
+    Args:
+        batch_tasks: In-flight process_players_batch tasks mapped to their player counts
+        return_when: asyncio.wait condition (FIRST_COMPLETED or ALL_COMPLETED)
+        
+    Returns:
+        Tuple of (players processed, records queued) by the finished batches
+    """
+    done, _ = await asyncio.wait(batch_tasks, return_when=return_when)
+    
+    finished_players = 0
+    finished_records = 0
+    for task in done:
+        finished_players += batch_tasks.pop(task)
+        finished_records += task.result()  # Re-raises a failed batch
+    
+    return finished_players, finished_records
+
+
+def log_progress(processed_players: int, total_players: int, total_records: int) -> None:
+    """
+    Log overall upload progress.
+    
+    Args:
+        processed_players: Players whose batches have finished
+        total_players: Players selected for this run
+        total_records: Team history records queued so far
+    """
+    logger.info("Progress: %s/%s players processed (%.1f%%), %s records queued",
+                processed_players, total_players, processed_players / total_players * 100, total_records)
+
+
+def positive_int(value: str) -> int:
+    """
+    Parse an argparse value that must be an integer >= 1.
+    
+    Args:
+        value: Raw command line value
+        
+    Returns:
+        Parsed integer
+    """
+    try:
+        parsed = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid integer: {value}")
+    if parsed < 1:
+        raise argparse.ArgumentTypeError(f"Must be at least 1, got {parsed}")
+    return parsed
 
 
 def parse_player_range(range_str: str) -> Tuple[int, int]:
@@ -319,8 +812,13 @@ async def main():
     parser = argparse.ArgumentParser(description='Upload MLB Player Team History')
     parser.add_argument('--player-range', required=True, 
                        help='Player ID range in format [start,end], e.g., [110001,833238]')
-    parser.add_argument('--batch-size', type=int, default=100,
-                       help='Number of players to process in each batch (default: 500)')
+    parser.add_argument('--batch-size', type=positive_int, default=100,
+                       help='Number of players to process in each batch (default: 100)')
+    parser.add_argument('--full-refresh', action='store_true',
+                       help='Ignore stored watermarks and refetch full transaction history')
+    parser.add_argument('--known-players-only', action='store_true',
+                       help='Skip players with no previously loaded transactions (run a full sweep '
+                            'periodically to pick up new players)')
     
     args = parser.parse_args()
     
@@ -334,64 +832,113 @@ async def main():
     logger.info(f"Total players requested: {total_players_requested}")
     logger.info(f"Batch size: {args.batch_size}")
     logger.info(f"Max concurrent requests: {MAX_CONCURRENT_REQUESTS}")
+    logger.info(f"Full refresh: {args.full_refresh}")
+    logger.info(f"Known players only: {args.known_players_only}")
     
     try:
-        # Step 1: Fetch valid MLBTeam IDs
-        valid_teams = fetch_valid_mlb_teams()
+        ensure_watermark_table()
         
-        # Step 2: Fetch valid MLBPlayer IDs in the requested range
-        valid_players = fetch_valid_mlb_players(start_id, end_id)
+        # Step 1: Count valid MLBPlayer IDs in the requested range (IDs are paged later)
+        total_valid_players = count_valid_mlb_players(start_id, end_id, args.known_players_only)
         
-        if not valid_players:
-            logger.warning(f"No players found in MLBPlayer table for range {start_id}-{end_id}")
+        if not total_valid_players:
+            if args.known_players_only:
+                logger.warning(f"No players with loaded transactions (--known-players-only) "
+                               f"found for range {start_id}-{end_id}")
+            else:
+                logger.warning(f"No players found in MLBPlayer table for range {start_id}-{end_id}")
             logger.info("=" * 60)
             logger.info("Script completed - no players to process")
             return
         
-        # Convert to sorted list for batch processing
-        valid_player_ids = sorted(list(valid_players))
-        total_valid_players = len(valid_player_ids)
+        # Load high-watermarks so re-runs only request new transactions
+        watermarks = {} if args.full_refresh else fetch_player_watermarks(start_id, end_id)
         
         logger.info(f"Found {total_valid_players} valid players in our database")
-        logger.info(f"Processing players: {valid_player_ids[:5]}{'...' if total_valid_players > 5 else ''}")
         
-        # Step 3: Process players in batches
-        all_records = []
+        # Step 2: Process players in batches over one shared HTTP session, keeping enough
+        # batches in flight to saturate the request semaphore and handing records to a
+        # background DB writer so fetching and inserting overlap
+        in_flight_batches = max_in_flight_batches(args.batch_size)
+        logger.info(f"Batches in flight: {in_flight_batches}")
         processed_players = 0
+        total_records = 0
+        last_progress_log = time.monotonic()
+        batch_tasks: Dict[asyncio.Task, int] = {}
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         
-        for i in range(0, total_valid_players, args.batch_size):
-            batch_player_ids = valid_player_ids[i:i + args.batch_size]
-            batch_start = batch_player_ids[0]
-            batch_end = batch_player_ids[-1]
-            
-            logger.info(f"Processing batch: {len(batch_player_ids)} players ({batch_start} to {batch_end})")
-            
-            # Process this batch asynchronously
-            batch_records = await process_players_batch(batch_player_ids, valid_teams, valid_players)
-            all_records.extend(batch_records)
-            
-            processed_players += len(batch_player_ids)
-            logger.info(f"Progress: {processed_players}/{total_valid_players} players processed "
-                       f"({processed_players/total_valid_players*100:.1f}%)")
-            logger.info(f"Batch yielded {len(batch_records)} team history records")
-            logger.info(f"Total records accumulated: {len(all_records)}")
+        db_queue: asyncio.Queue = asyncio.Queue(maxsize=DB_QUEUE_SIZE)
+        # Dedicated single thread so every insert reuses one connection and no insert
+        # can still be running when connections are closed
+        db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        writer = asyncio.create_task(db_writer(db_queue, db_executor))
+        # Player ID pages are read on another thread/connection so they never block the loop
+        db_reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-reader')
+        
+        connector = aiohttp.TCPConnector(
+            limit=0,  # Concurrency is bounded by the semaphore, not the pool
+            limit_per_host=MAX_CONCURRENT_REQUESTS,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True
+        )
+        async with aiohttp.ClientSession(connector=connector, timeout=API_CLIENT_TIMEOUT) as session:
+            async for batch_player_ids in iter_valid_mlb_players(db_reader, start_id, end_id,
+                                                                 args.batch_size, args.known_players_only):
+                # Wait for a free slot in the window before starting the next batch
+                if len(batch_tasks) >= in_flight_batches:
+                    finished_players, finished_records = await wait_for_batches(batch_tasks)
+                    processed_players += finished_players
+                    total_records += finished_records
+                    
+                    # Throttle progress to once per PROGRESS_LOG_INTERVAL seconds
+                    if time.monotonic() - last_progress_log >= PROGRESS_LOG_INTERVAL:
+                        log_progress(processed_players, total_valid_players, total_records)
+                        last_progress_log = time.monotonic()
+                
+                batch_start = batch_player_ids[0]
+                batch_end = batch_player_ids[-1]
+                
+                logger.debug("Processing batch: %s players (%s to %s)", len(batch_player_ids), batch_start, batch_end)
+                
+                # Process this batch asynchronously
+                task = asyncio.create_task(process_players_batch(session, semaphore, batch_player_ids,
+                                                                 watermarks, db_queue, writer))
+                batch_tasks[task] = len(batch_player_ids)
             
-            # Insert records in chunks to avoid memory issues
-            if len(all_records) >= 100:
-                bulk_insert_team_history(all_records)
-                all_records = []  # Clear the accumulator
+            # Let the remaining batches finish
+            if batch_tasks:
+                finished_players, finished_records = await wait_for_batches(batch_tasks, asyncio.ALL_COMPLETED)
+                processed_players += finished_players
+                total_records += finished_records
+            log_progress(processed_players, total_valid_players, total_records)
         
-        # Insert any remaining records
-        if all_records:
-            bulk_insert_team_history(all_records)
+        # Signal the writer to finish once everything is queued
+        await enqueue_records(db_queue, writer, None)
+        await writer
         
         logger.info("=" * 60)
         logger.info("MLB Player Team History upload completed successfully")
         
     except Exception as e:
         logger.error(f"Script failed with error: {e}")
+        for task in locals().get('batch_tasks', {}):
+            task.cancel()
+        if 'writer' in locals():
+            writer.cancel()
         raise
+    finally:
+        if 'db_reader' in locals():
+            db_reader.shutdown(wait=True)
+        if 'db_executor' in locals():
+            db_executor.shutdown(wait=True)
+        close_db_connections()
 
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    try:
+        import uvloop  # Optional libuv-based event loop (not available on Windows)
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main()) 
\ No newline at end of file